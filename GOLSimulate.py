@@ -5,18 +5,22 @@ import matplotlib.animation as animation
 import matplotlib
 from scipy import stats
 import os
+from Observables import Observables
+from concurrent.futures import ThreadPoolExecutor
 plt.style.use('ggplot')
 
 
 
 class Simulation(object):
     
-    def __init__(self, dim, initializer='random'):
+    def __init__(self, dim, initializer='random', threads=None):
         
         # Initializer - if no state initializer selected, default to random
+        # If a number of threads is given, the lattice is updated in parallel horizontal stripes
         
         self.dim = dim
         self.init = initializer
+        self.threads = threads
         self.lattice = None
         
         if self.init == 'random':
@@ -38,6 +42,9 @@ class Simulation(object):
             raise ValueError('Initializer usage [random/absorbing/glider/blinker/beehive]')
             
         self.activity = []
+        
+        if self.threads:
+            self.useStripes()
                     
     def useRandom(self):
         
@@ -119,6 +126,10 @@ class Simulation(object):
         
         # Updates the state of the lattice based on the conditions of the game
         
+        if self.threads:
+            self.updateStriped()
+            return
+        
         updatedLattice = np.zeros((self.dim, self.dim))
         d = self.dim
         
@@ -154,6 +165,64 @@ class Simulation(object):
                     
         self.lattice = updatedLattice
         
+    def useStripes(self):
+        
+        # Splits the rows into one stripe per thread, each with a buffer padded by a one cell halo on every side
+        
+        bounds = np.linspace(0, self.dim, min(self.threads, self.dim) + 1).astype(int)
+        
+        self.stripes = list(zip(bounds[:-1], bounds[1:]))
+        self.halos = [np.zeros((r1-r0+2, self.dim+2)) for r0, r1 in self.stripes]
+        self.sums = [np.zeros((r1-r0, self.dim)) for r0, r1 in self.stripes]
+        self.pool = ThreadPoolExecutor(max_workers=len(self.stripes))
+        
+    def close(self):
+        
+        # Shuts down the stripe thread pool, if there is one, once the simulation is no longer needed
+        
+        if self.threads:
+            self.pool.shutdown()
+        
+    def updateStripe(self, lattice, updatedLattice, n):
+        
+        # Updates a single stripe, NumPy releases the GIL so stripes run concurrently
+        
+        r0, r1 = self.stripes[n]
+        halo = self.halos[n]
+        neighbourStatesSum = self.sums[n]
+        d = self.dim
+        
+        # Halo exchange - copy in the stripe and the neighbouring row above and below, wrapping periodically
+        
+        halo[1:-1, 1:-1] = lattice[r0:r1]
+        halo[0, 1:-1] = lattice[(r0-1)%d]
+        halo[-1, 1:-1] = lattice[r1%d]
+        halo[:, 0] = halo[:, -2]
+        halo[:, -1] = halo[:, 1]
+        
+        # Sum of the 8 neighbours, accumulated in place to avoid allocating temporaries on large lattices
+        
+        np.add(halo[:-2, :-2], halo[:-2, 1:-1], out=neighbourStatesSum)
+        
+        for di, dj in [(0, 2), (1, 0), (1, 2), (2, 0), (2, 1), (2, 2)]:
+            neighbourStatesSum += halo[di:di+r1-r0, dj:dj+d]
+        
+        alive = (neighbourStatesSum == 3) | ((lattice[r0:r1] == 1) & (neighbourStatesSum == 2))
+        updatedLattice[r0:r1] = alive
+        
+    def updateStriped(self):
+        
+        # Same rules as update, with every stripe of the lattice processed on the thread pool
+        
+        updatedLattice = np.empty((self.dim, self.dim))
+        
+        jobs = [self.pool.submit(self.updateStripe, self.lattice, updatedLattice, n) for n in range(len(self.stripes))]
+        
+        for job in jobs:
+            job.result()
+        
+        self.lattice = updatedLattice
+        
         
     def COM(self):
         
@@ -178,11 +247,11 @@ class Simulation(object):
         
 class Animation(object):
     
-    def __init__(self, dim, init):
+    def __init__(self, dim, init, threads=None):
         
         # Set up a simulation to be animated
         
-        self.sim = Simulation(dim, initializer=init)
+        self.sim = Simulation(dim, initializer=init, threads=threads)
         self.fig, self.ax = plt.subplots()
         self.plot = self.ax.imshow(self.sim.lattice, cmap='gray')
         self.ani = None
@@ -206,17 +275,22 @@ class Animation(object):
     
 class DataCollection(object):
     
-    def __init__(self, dim):
+    def __init__(self, dim, threads=None):
         
         # Initializer for data collection
         
         self.dim = dim
-        self.sim = Simulation(self.dim)
+        self.threads = threads
+        self.sim = Simulation(self.dim, threads=self.threads)
         
     def equilibrationTime(self):
         
         # Determines equilibration time
         
+        # Correlation length and cluster size distribution of live cells during this run, sampled every 10 steps
+        
+        self.observables = Observables(stride=10, diagonal=True)
+        
         time = 0  
         unique = set()
         prevUnique = set()  
@@ -236,6 +310,7 @@ class DataCollection(object):
                 time += 1
                 self.sim.update()
                 self.sim.countActivity()
+                self.observables.sample(time, self.sim.lattice)
         
             prevIter = self.sim.activity[-10:]
             unique = set(prevIter)  
@@ -247,7 +322,8 @@ class DataCollection(object):
         
         # Calculates glider velocity
         
-        self.sim = Simulation(self.dim, initializer='glider')
+        self.sim.close()
+        self.sim = Simulation(self.dim, initializer='glider', threads=self.threads)
         
         tList = []
         positionList = []
@@ -282,17 +358,30 @@ class DataCollection(object):
     
     def equilibrationTimeExperiment(self):
         
-        # Conducts 750 simulations and returns the list of equilibration times
+        # Conducts 750 simulations and returns the equilibration times, the mean correlation length of each run
+        # and the cluster size distribution summed over every run
         
         tList = []
+        correlationLengths = []
+        clusterDistribution = np.zeros(1, dtype=int)
         
         for i in range(750):
             
-            self.sim = Simulation(self.dim)
+            self.sim.close()
+            self.sim = Simulation(self.dim, threads=self.threads)
             time = self.equilibrationTime()
             tList.append(time)
             
-        return tList
+            correlationLengths.append(self.observables.meanCorrelationLength())
+            
+            distribution = self.observables.clusterSizeDistribution()
+            size = max(len(clusterDistribution), len(distribution))
+            clusterDistribution = np.pad(clusterDistribution, (0, size - len(clusterDistribution)))
+            clusterDistribution += np.pad(distribution, (0, size - len(distribution)))
+            
+            self.observables.close()
+            
+        return tList, correlationLengths, clusterDistribution
     
     def plotGliderVelocity(self):
         
@@ -308,7 +397,7 @@ class DataCollection(object):
         
     def plotEquilibriumTimes(self):
         
-        equiTimeList = self.equilibrationTimeExperiment()
+        equiTimeList, correlationLengths, clusterDistribution = self.equilibrationTimeExperiment()
         
         plt.hist(equiTimeList, bins=50)
         plt.xlabel('timestep')
@@ -316,21 +405,40 @@ class DataCollection(object):
         plt.title('Histogram of System Equilibration Time')
         plt.show()
         
+        plt.hist(correlationLengths, bins=50)
+        plt.xlabel('correlation length')
+        plt.ylabel('counts')
+        plt.title('Histogram of Mean Correlation Length During Equilibration')
+        plt.show()
+        
+        sizes = np.nonzero(clusterDistribution)[0]
+        
+        plt.loglog(sizes, clusterDistribution[sizes], marker='.', linestyle='none', color='k')
+        plt.xlabel('cluster size')
+        plt.ylabel('counts')
+        plt.title('Cluster Size Distribution During Equilibration')
+        plt.show()
+        
 
 def runExperiment():
     
     sim_dim = int(input('System size: '))
+    sim_threads = int(input('Number of threads (0 for serial): '))
+    
+    if sim_threads < 0:
+        raise ValueError('Usage [0 for serial, or a positive number of threads]')
+    
     sim_or_data = int(input('Visualize / collect data [0/1]: '))
     
     if sim_or_data == 0:
         
         sim_type = str(input('What simulation type? [random/absorbing/glider/blinker/beehive]: '))
-        anim = Animation(sim_dim, sim_type)
+        anim = Animation(sim_dim, sim_type, threads=sim_threads)
         anim.run()
         
     elif sim_or_data == 1:
         
-        data_coll = DataCollection(sim_dim)
+        data_coll = DataCollection(sim_dim, threads=sim_threads)
         data_type = int(input('Glider velocity / equilibration times [0/1]: '))
         
         if data_type == 0:
@@ -0,0 +1,179 @@
+import numpy as np
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Observables(object):
+
+    def __init__(self, stride, value=1, diagonal=False):
+
+        # Samples spatial observables of the cells in a given state every stride steps
+        # Measurements run on a background thread on a boolean mask of those cells, so the simulation is not held up
+
+        self.stride = stride
+        self.value = value
+        self.diagonal = diagonal
+
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.jobs = []
+        self.skipped = 0
+
+    def sample(self, step, lattice):
+
+        # Queues a measurement of the lattice if the step falls on the stride
+        # At most one measurement is in flight, samples that arrive while it is still running are skipped and counted
+
+        if step % self.stride != 0:
+            return
+
+        if self.jobs and not self.jobs[-1].done():
+            self.skipped += 1
+            return
+
+        self.jobs.append(self.pool.submit(self.measure, lattice == self.value))
+
+    def measure(self, mask):
+
+        # Returns the correlation length, correlation function and cluster sizes of a boolean mask of cells
+
+        corr = self.correlationFunction(mask, True)
+        labels = self.labelClusters(mask, True, self.diagonal)
+
+        return self.correlationLength(corr), corr, self.clusterSizes(labels)
+
+    def close(self):
+
+        # Waits for any queued measurements, then shuts down the background thread
+
+        self.pool.shutdown()
+
+    def results(self):
+
+        # Waits for all queued measurements and returns them in the order they were sampled
+
+        return [job.result() for job in self.jobs]
+
+    def meanCorrelationLength(self):
+
+        lengths = [length for length, corr, sizes in self.results()]
+
+        return np.mean(lengths) if lengths else 0.0
+
+    def clusterSizeDistribution(self):
+
+        # Number of clusters of each size, summed over every sample
+
+        sizes = [sizes for length, corr, sizes in self.results()]
+
+        if not sizes:
+            return np.zeros(1, dtype=int)
+
+        return np.bincount(np.concatenate(sizes), minlength=1)
+
+    def meanClusterSize(self):
+
+        # Mean number of cells per cluster, over every cluster of every sample
+
+        distribution = self.clusterSizeDistribution()
+
+        if not distribution.sum():
+            return 0.0
+
+        return np.sum(np.arange(len(distribution))*distribution)/distribution.sum()
+
+    @staticmethod
+    def correlationFunction(lattice, value=1):
+
+        # Static method computing the radially averaged connected two-point correlation of the cells in a given
+        # state, using the Wiener-Khinchin theorem so the periodic autocorrelation costs O(N log N)
+
+        field = (lattice == value).astype(float)
+        field -= field.mean()
+
+        power = np.abs(np.fft.rfft2(field))**2
+        corr = np.fft.irfft2(power, s=field.shape)/field.size
+
+        # Bin by periodic distance from the origin, up to half the lattice
+
+        dx = np.minimum(np.arange(field.shape[0]), field.shape[0] - np.arange(field.shape[0]))
+        dy = np.minimum(np.arange(field.shape[1]), field.shape[1] - np.arange(field.shape[1]))
+        r = np.rint(np.hypot(dx[:, None], dy[None, :])).astype(int).ravel()
+
+        radial = np.bincount(r, corr.ravel())/np.bincount(r)
+
+        return radial[:min(field.shape)//2 + 1]
+
+    @staticmethod
+    def correlationLength(corr):
+
+        # Static method returning the distance at which the normalised correlation first drops below 1/e
+
+        if corr[0] <= 0:
+            return 0.0
+
+        normalised = corr/corr[0]
+        below = np.nonzero(normalised < 1/np.e)[0]
+
+        if not below.size:
+            return float(len(corr) - 1)
+
+        # Linear interpolation between the two bracketing distances
+
+        r = below[0]
+
+        return (r - 1) + (normalised[r-1] - 1/np.e)/(normalised[r-1] - normalised[r])
+
+    @staticmethod
+    def labelClusters(lattice, value=1, diagonal=False):
+
+        # Static method labelling connected clusters of cells in a given state, with periodic boundaries
+        # Clusters are labelled on the open lattice in linear time, then merged across the edges with union-find
+
+        structure = np.ones((3, 3)) if diagonal else None
+        labels, count = ndimage.label(lattice == value, structure=structure)
+
+        parent = np.arange(count + 1)
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        # Pairs of edge cells that touch once the lattice is wrapped, only these labels can be merged
+
+        shifts = [-1, 0, 1] if diagonal else [0]
+        pairs = []
+
+        for shift in shifts:
+            pairs.append(np.stack([labels[0], np.roll(labels[-1], shift)], axis=-1))
+            pairs.append(np.stack([labels[:, 0], np.roll(labels[:, -1], shift)], axis=-1))
+
+        pairs = np.concatenate(pairs)
+        pairs = np.unique(pairs[(pairs > 0).all(axis=-1)], axis=0)
+
+        for x, y in pairs:
+            rootX, rootY = find(x), find(y)
+
+            if rootX != rootY:
+                parent[max(rootX, rootY)] = min(rootX, rootY)
+
+        # Every other label is its own root, so only the edge labels need resolving before the vectorised relabel
+
+        roots = np.arange(count + 1)
+        edgeLabels = np.unique(pairs)
+        roots[edgeLabels] = [find(x) for x in edgeLabels]
+
+        # Roots never exceed their labels, so numbering the roots in order gives compact labels in linear time
+
+        isRoot = roots == np.arange(count + 1)
+        compact = (np.cumsum(isRoot) - 1)[roots]
+
+        return compact[labels]
+
+    @staticmethod
+    def clusterSizes(labels):
+
+        # Static method returning the number of cells in each labelled cluster
+
+        return np.bincount(labels.ravel())[1:]
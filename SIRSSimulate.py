@@ -5,6 +5,7 @@ import matplotlib.animation as animation
 import matplotlib
 from scipy import stats
 import os
+from Observables import Observables
 plt.style.use('ggplot')
 
 
@@ -25,19 +26,17 @@ class Simulation(object):
         
         # Initializes a random state where each cell can either be infected, recovered or susceptible
         
-        self.lattice = np.random.rand(self.dim, self.dim)
+        self.lattice = self.randomStates(self.dim)
         
-        for i in range(len(self.lattice)):
-            for j in range(len(self.lattice)):
-                
-                if self.lattice[i, j] < 1/3:
-                    self.lattice[i, j] = -1
-                    
-                elif self.lattice[i, j] < 2/3:
-                    self.lattice[i, j] = 0
-                    
-                else:
-                    self.lattice[i, j] = 1
+    @staticmethod
+    def randomStates(dim, shape=()):
+        
+        # Static method returning dim x dim lattices of equally likely recovered, susceptible and infected cells,
+        # with any leading batch shape
+        
+        states = np.random.rand(*shape, dim, dim)
+        
+        return np.where(states < 1/3, -1., np.where(states < 2/3, 0., 1.))
                     
     def update(self):
         
@@ -89,13 +88,262 @@ class Simulation(object):
         # Initializes certain cells to be immune to infection
         
         self.useRandom()
+        self.lattice[self.immuneMask(self.dim, pimm)] = -2
         
-        for i in range(len(self.lattice)):
-            for j in range(len(self.lattice)):
-                
-                if random.random() < pimm:
-                    self.lattice[i, j] = -2
-                    
+    @staticmethod
+    def immuneMask(dim, pimm):
+        
+        # Static method returning a boolean mask of immune cells, one dim x dim lattice per entry if pimm is an array
+        
+        pimm = np.asarray(pimm)
+        
+        return np.random.rand(*pimm.shape, dim, dim) < pimm[..., None, None]
+
+
+class SiteSet(object):
+
+    def __init__(self):
+
+        # Set of flat lattice indices supporting O(1) add, remove and uniform random choice
+
+        self.sites = []
+        self.position = {}
+
+    def __len__(self):
+
+        return len(self.sites)
+
+    def add(self, k):
+
+        if k not in self.position:
+            self.position[k] = len(self.sites)
+            self.sites.append(k)
+
+    def remove(self, k):
+
+        # Swaps the removed site with the last entry so the list stays dense
+
+        idx = self.position.pop(k, None)
+
+        if idx is None:
+            return
+
+        last = self.sites.pop()
+
+        if last != k:
+            self.sites[idx] = last
+            self.position[last] = idx
+
+    def choice(self):
+
+        return self.sites[int(random.random()*len(self.sites))]
+
+
+class GillespieSimulation(Simulation):
+
+    def __init__(self, dim, pi, pr, ps):
+
+        # Rejection-free continuous-time version of Simulation. Under random sequential updating every
+        # site is drawn once per sweep on average, so each transition fires at its probability per sweep
+        # and one unit of time here corresponds to one call of Simulation.update
+
+        self.time = 0
+
+        super().__init__(dim, pi, pr, ps)
+
+    def useRandom(self):
+
+        super().useRandom()
+        self.buildIndex()
+
+    def initializeImmune(self, pimm):
+
+        super().initializeImmune(pimm)
+        self.buildIndex()
+
+    def neighbours(self, k):
+
+        # Flat indices of the 4 nearest neighbours of site k, with periodic boundaries
+
+        d = self.dim
+        i, j = divmod(k, d)
+
+        return (i*d + (j+1)%d, ((i+1)%d)*d + j, i*d + (j-1)%d, ((i-1)%d)*d + j)
+
+    def buildIndex(self):
+
+        # Rebuilds the active site sets and the infected neighbour count of every site from the lattice
+
+        d = self.dim
+
+        self.infected = SiteSet()
+        self.recovered = SiteSet()
+        self.exposed = SiteSet()
+        self.infectedNeighbours = [0]*d**2
+
+        flat = self.lattice.ravel()
+
+        for k in range(d**2):
+
+            if flat[k] == 1:
+                self.infected.add(k)
+
+                for n in self.neighbours(k):
+                    self.infectedNeighbours[n] += 1
+
+            elif flat[k] == -1:
+                self.recovered.add(k)
+
+        for k in range(d**2):
+            if flat[k] == 0 and self.infectedNeighbours[k] > 0:
+                self.exposed.add(k)
+
+    def infect(self, k):
+
+        # Susceptible -> infected, exposing any susceptible neighbours
+
+        self.exposed.remove(k)
+        self.infected.add(k)
+        self.lattice[divmod(k, self.dim)] = 1
+
+        for n in self.neighbours(k):
+            self.infectedNeighbours[n] += 1
+
+            if self.lattice[divmod(n, self.dim)] == 0:
+                self.exposed.add(n)
+
+    def recover(self, k):
+
+        # Infected -> recovered, removing neighbours from the exposed set once they have no infected neighbour
+
+        self.infected.remove(k)
+        self.recovered.add(k)
+        self.lattice[divmod(k, self.dim)] = -1
+
+        for n in self.neighbours(k):
+            self.infectedNeighbours[n] -= 1
+
+            if self.infectedNeighbours[n] == 0:
+                self.exposed.remove(n)
+
+    def resusceptible(self, k):
+
+        # Recovered -> susceptible, immediately exposed if it borders an infected cell
+
+        self.recovered.remove(k)
+        self.lattice[divmod(k, self.dim)] = 0
+
+        if self.infectedNeighbours[k] > 0:
+            self.exposed.add(k)
+
+    def update(self):
+
+        # Advances the lattice by one sweep of time, firing transitions in proportion to their rates
+
+        target = np.floor(self.time) + 1
+
+        while True:
+
+            rateInfect = self.pi*len(self.exposed)
+            rateRecover = self.pr*len(self.infected)
+            rateSusceptible = self.ps*len(self.recovered)
+            totalRate = rateInfect + rateRecover + rateSusceptible
+
+            # Absorbing state, nothing can change until the end of the sweep
+
+            if totalRate == 0:
+                break
+
+            self.time += random.expovariate(totalRate)
+
+            # Waiting times are memoryless, so an overshoot can be discarded
+
+            if self.time >= target:
+                break
+
+            r = random.random()*totalRate
+
+            if r < rateInfect:
+                self.infect(self.exposed.choice())
+
+            elif r < rateInfect + rateRecover:
+                self.recover(self.infected.choice())
+
+            else:
+                self.resusceptible(self.recovered.choice())
+
+        self.time = target
+
+    def countInfected(self):
+
+        return len(self.infected)
+
+
+class EnsembleSimulation(object):
+
+    def __init__(self, dim, pi, pr, ps, fracImmune):
+
+        # Runs one independent lattice per immune fraction side by side, each with random sequential updates
+
+        self.dim = dim
+        self.pi = pi
+        self.pr = pr
+        self.ps = ps
+        self.fracImmune = np.asarray(fracImmune)
+
+        size = len(self.fracImmune)
+
+        # Same initial state as Simulation.initializeImmune, generated for every lattice at once
+
+        self.lattices = Simulation.randomStates(dim, (size,))
+        self.lattices[Simulation.immuneMask(dim, self.fracImmune)] = -2
+
+        # Lattices are flattened so every draw of a sweep is a single fancy index across the ensemble
+
+        self.flat = self.lattices.reshape(-1)
+        self.active = np.arange(size)
+        self.deactivate()
+
+    def deactivate(self):
+
+        # Drops lattices where infection has died out, as they can never be reinfected
+
+        self.active = self.active[self.countInfected()[self.active] > 0]
+
+    def update(self):
+
+        # Performs one sweep on every active lattice, each draw updating one random site per lattice
+
+        d = self.dim
+        draws = (d**2, len(self.active))
+
+        i = np.random.randint(0, d, draws)
+        j = np.random.randint(0, d, draws)
+        r = np.random.rand(*draws)
+
+        offset = self.active*d**2
+        k = offset + i*d + j
+        neighbours = np.stack([offset + i*d + (j+1)%d, offset + ((i+1)%d)*d + j,
+                               offset + i*d + (j-1)%d, offset + ((i-1)%d)*d + j], axis=-1)
+
+        for n in range(d**2):
+
+            state = self.flat[k[n]]
+            infectedNeighbour = (self.flat[neighbours[n]] == 1).any(axis=-1)
+
+            self.flat[k[n]] = np.where((state == -1) & (r[n] < self.ps), 0,
+                              np.where((state == 0) & infectedNeighbour & (r[n] < self.pi), 1,
+                              np.where((state == 1) & (r[n] < self.pr), -1, state)))
+
+        self.deactivate()
+
+    def countInfected(self):
+
+        # Number of infected cells in every lattice of the ensemble
+
+        return np.sum(self.lattices == 1, axis=(1, 2))
+
+
 class Animation(object):
     
     def __init__(self, dim, pi, pr, ps, immune=False):
@@ -131,12 +379,13 @@ class Animation(object):
     
 class DataCollection(object):
     
-    def __init__(self, dim):
+    def __init__(self, dim, engine=Simulation):
         
-        # Initializer for data collection
+        # Initializer for data collection, engine is the simulation class used for phase and wave runs
     
         self.dim = dim
         self.pr = 0.5
+        self.engine = engine
         
     def calcError(self, x):
         
@@ -168,7 +417,7 @@ class DataCollection(object):
             for j in range(len(self.ps)):
                 
                 infectedData = []
-                self.sim = Simulation(self.dim, self.pi[i], self.pr, self.ps[j])
+                self.sim = self.engine(self.dim, self.pi[i], self.pr, self.ps[j])
     
                 for n in range(1000):  
                     self.sim.update()
@@ -200,17 +449,24 @@ class DataCollection(object):
         infectedVar = []
         errors = []
         
+        # Correlation length and mean cluster size of the infected cells, sampled every 100 sweeps
+        
+        correlationLengths = []
+        clusterSizes = []
+        
         for i in range(len(self.pi)):
             
             infectedData = []
             
-            self.sim = Simulation(self.dim, self.pi[i], self.pr, self.ps)
+            self.sim = self.engine(self.dim, self.pi[i], self.pr, self.ps)
+            self.observables = Observables(stride=100)
 
             for n in range(10000):
                 self.sim.update()
                 
                 if n > 100:
                     infectedData.append(self.sim.countInfected())
+                    self.observables.sample(n, self.sim.lattice)
                     
                 if n%1000 == 0:
                     print(f'Cycle {n/100}% complete.')
@@ -221,6 +477,14 @@ class DataCollection(object):
             error = self.calcError(infectedData)
             errors.append(error)
             
+            correlationLength = self.observables.meanCorrelationLength()
+            correlationLengths.append(correlationLength)
+            
+            clusterSize = self.observables.meanClusterSize()
+            clusterSizes.append(clusterSize)
+            
+            self.observables.close()
+            
             # Write data to outfile
         
             fileExists = os.path.isfile('wave_data.csv')
@@ -229,7 +493,13 @@ class DataCollection(object):
                     f.write('Infection Variance, Infection Prob., Error\n')
                 f.write(f'{var}, {self.pi[i]}, {error}\n')
                 
-        return infectedVar, errors, self.pi
+            fileExists = os.path.isfile('wave_observables.csv')
+            with open('wave_observables.csv', 'a+') as f:
+                if not fileExists:
+                    f.write('Infection Prob., Correlation Length, Mean Cluster Size\n')
+                f.write(f'{self.pi[i]}, {correlationLength}, {clusterSize}\n')
+                
+        return infectedVar, errors, self.pi, correlationLengths, clusterSizes
                 
                 
     def immunityAnalysis(self):
@@ -237,24 +507,32 @@ class DataCollection(object):
         # Determines how the number of infections responds to various immune fractions in the population
         
         fracImmune = np.linspace(0, 1, 50)
-        averageInfections = []
+        infectedSum = np.zeros(len(fracImmune))
         
-        for frac in fracImmune:
-            
-            infectedData = []  
-            self.sim = Simulation(self.dim, 0.5, 0.5, 0.5)
-            self.sim.initializeImmune(frac)
+        sweeps = 2500
+        burnIn = 100
+        
+        self.sim = EnsembleSimulation(self.dim, 0.5, 0.5, 0.5, fracImmune)
+        
+        for n in range(sweeps):
+            self.sim.update()
             
-            for n in range(2500):
-                self.sim.update()
+            if n > burnIn:
+                infectedSum += self.sim.countInfected()
                 
-            if n > 100:
-                infectedData.append(self.sim.countInfected())
+            # Lattices where infection has died out contribute zero to every later sample
                 
-            mean = np.mean(np.array(infectedData))
-            averageInfections.append(mean)
-            
-            # Write data to outfile 
+            if len(self.sim.active) == 0:
+                break
+                
+            if n%(sweeps//10) == 0:
+                print(f'Cycle {100*n/sweeps}% complete.')
+                
+        averageInfections = infectedSum/(sweeps - burnIn - 1)
+        
+        # Write data to outfile 
+        
+        for frac, mean in zip(fracImmune, averageInfections):
             
             fileExists = os.path.isfile('immunity_data.csv')
             with open('immunity_data.csv', 'a+') as f:
@@ -280,7 +558,7 @@ class DataCollection(object):
         
     def plotWaves(self):
         
-        infectedVar, errors, pi = self.waveAnalysis()
+        infectedVar, errors, pi, correlationLengths, clusterSizes = self.waveAnalysis()
         
         plt.plot(pi, infectedVar)
         plt.errorbar(pi, infectedVar, yerr=errors, fmt=".", color='k')
@@ -289,6 +567,12 @@ class DataCollection(object):
         plt.ylabel('infection variance')
         plt.show()
         
+        plt.plot(pi, correlationLengths, color='k')
+        plt.title('Infected Correlation Length (p$_{2}$ = p$_{3}$ = 0.5)')
+        plt.xlabel('infection probability')
+        plt.ylabel('correlation length')
+        plt.show()
+        
     def plotImmunity(self):
         
         fracImmune, averageInfections = self.immunityAnalysis()
@@ -337,9 +621,26 @@ def runExperiment():
         
     elif sim_type == 2:
         
-        data_coll = DataCollection(sim_dim)
         data = str(input('Choose data to collect [phase/waves/immunity]: '))
         
+        # Only the phase and wave experiments can swap update engine, immunity always runs as an ensemble
+        
+        if data == 'phase' or data == 'waves':
+            
+            engine = str(input('Choose update engine [sequential/gillespie]: '))
+            
+            if engine == 'sequential':
+                data_coll = DataCollection(sim_dim)
+                
+            elif engine == 'gillespie':
+                data_coll = DataCollection(sim_dim, engine=GillespieSimulation)
+                
+            else:
+                raise ValueError('Usage [sequential/gillespie]')
+                
+        else:
+            data_coll = DataCollection(sim_dim)
+        
         if data == 'phase':
             data_coll.plotPhaseDiagram()
             